@@ -14,7 +14,8 @@ SOURCES="\
     output_total_depfil.png
     output_year_depfil.png
     tagged_history.csv
-    cache_v4.json
+    cache_v4.jsonl
+    commit_list.json
     index.html
     flamegraph.html
     loc.json
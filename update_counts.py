@@ -7,59 +7,103 @@
 # So this script consumes about 1 minute of CPU time per day.
 # That's acceptable. (Less pessimistic numbers predict about 15 seconds per day.)
 
-import datetime
-import json
+import concurrent.futures
+import functools
 import os
+import re
 import subprocess
 import sys
+import tempfile
 import time
-from typing import Callable, TypeAlias
+from typing import Iterator, TypeAlias
+
+import orjson
 
 SERENITY_DIR = "serenity/"
 FILENAME_CSV = "tagged_history.csv"
-FILENAME_CACHE = "cache_v4.json"
+# All commits on master with their dates, oldest first, so that only new ones need to be asked from git.
+FILENAME_COMMIT_LIST = "commit_list.json"
+# One JSON object per line, so that new entries can simply be appended.
+FILENAME_CACHE = "cache_v4.jsonl"
+# Snapshots in the old format (a single JSON object), used when FILENAME_CACHE doesn't exist yet.
+FILENAME_CACHE_LEGACY = "cache_v4.json"
 FILENAME_CACHE_COLD = "cache_cold_v4.json"
-# Save the cache only every X commits, instead of after every commit.
+# Offset of gnuplot's epoch on this machine. Delete this file after upgrading gnuplot.
+FILENAME_GNUPLOT_EPOCH = ".gnuplot_epoch"
+FLAMEGRAPH_OUTPUTS = ("todo.json", "loc.json", "ratio.csv")
+# Describes the Serenity checkout that the flame graph outputs were generated from.
+FILENAME_FLAMEGRAPH_STAMP = ".flamegraph_stamp"
+# Part of the stamp. Bump this whenever the flame graph outputs change for the same checkout, e.g. the way files are counted.
+FLAMEGRAPH_FORMAT_VERSION = 2
+# See upgrade_cache.py for what the versions mean.
+CACHE_VERSION = 4
+# Where the old single-object caches keep their version.
+MAGIC_VERSION_KEY = "0000000000000000000000000000000000000000_version"
+# Sync the cache to disk only every X commits, instead of after every commit.
 SAVE_CACHE_INV_FREQ = 200
+# Files that are considered for the flame graph.
+SOURCE_EXTENSIONS = (".h", ".c", ".cpp", ".html", ".js", ".sh", ".txt", ".cmake")
+IGNORED_DIRECTORIES = (".git", ".devcontainer")
+# Commits are counted in parallel, but more workers than cores would only fight over the same CPUs.
+MAX_WORKERS = os.cpu_count() or 1
+# All output we parse is ASCII, so spare git any locale handling.
+GIT_ENV = {**os.environ, "LC_ALL": "C"}
+
+# Matches every line that contains any of the patterns, when applied to the lowercased file.
+MATCHING_LINE_RE = re.compile(rb"^.*(?:fixme|todo|deprecatedflystring|deprecatedfile).*$", re.MULTILINE)
+# Lines that are empty, only whitespace, or start with a "//" comment.
+# Applied after all line breaks were turned into "\n", so "\r" can't show up here.
+NON_CODE_LINE_RE = re.compile(rb"^[ \t\f\v]*(?://|\n|\Z)", re.MULTILINE)
 
 Cache: TypeAlias = dict[str, tuple[int, int, int]]
 OutputNode: TypeAlias = dict[str, str | int | list]
 
+# Counts per blob id and whether it's forced to be binary or text, for the last commit counted by each worker process.
+BLOB_COUNTS: dict[tuple[bytes, bool | None], tuple[int, int, int]] = {}
+# Whether each path is forced to be binary or text, for the .gitattributes files of the commits we're looking at.
+PATH_BINARY: dict[tuple[tuple[bytes, bytes], ...], dict[bytes, bool | None]] = {}
+
 class Node:   # noqa: too-few-public-methods
+    # There is one of these for every file and directory, so avoid the per-instance __dict__.
+    __slots__ = ("name", "children", "children_by_name", "todos", "locs")
+
     name: str
     children: list['Node']
-    todos: int = 0
-    locs: int = 0
+    children_by_name: dict[str, 'Node']
+    todos: int
+    locs: int
 
     def __init__(self, name: str, children: list['Node']):
         self.name = name
         self.children = children
+        self.children_by_name = {child.name: child for child in children}
+        self.todos = 0
+        self.locs = 0
 
 
 def fetch_new() -> None:
     subprocess.run(["git", "-C", SERENITY_DIR, "fetch"], check=True)
 
 
-def determine_commit_and_date_list() -> list[tuple[str, int]]:
+def log_commits_and_dates(*revisions: str) -> list[tuple[str, int]]:
     result = subprocess.run(
         [
             "git",
             "-C",
             SERENITY_DIR,
             "log",
-            "origin/master",
+            *revisions,
             "--reverse",
             "--format=%H %ct",
         ],
         check=True,
         capture_output=True,
         text=True,
+        env=GIT_ENV,
     )
     lines: list[str] = result.stdout.split("\n")
     assert lines[-1] == "", result.stdout[-10:]
     lines.pop()
-    assert lines[-1] != "", result.stdout[-10:]
-    print(f"Repo has {len(lines)} commits.")
     entries: list[tuple[str, int]] = []
     for line in lines:
         parts = line.split(" ")
@@ -68,104 +112,254 @@ def determine_commit_and_date_list() -> list[tuple[str, int]]:
     return entries
 
 
+def is_ancestor_of_master(commit: str) -> bool:
+    result = subprocess.run(
+        ["git", "-C", SERENITY_DIR, "merge-base", "--is-ancestor", commit, "origin/master"],
+        check=False,
+        capture_output=True,
+    )
+    # 1 means "no", anything else means the commit is unknown, e.g. because history was rewritten.
+    return result.returncode == 0
+
+
+def determine_commit_and_date_list() -> list[tuple[str, int]]:
+    entries: list[tuple[str, int]] = []
+    if os.path.exists(FILENAME_COMMIT_LIST):
+        with open(FILENAME_COMMIT_LIST, "rb") as commit_list_file:
+            entries = [(entry[0], entry[1]) for entry in orjson.loads(commit_list_file.read())]
+    if entries and is_ancestor_of_master(entries[-1][0]):
+        # Only ask git for the new commits. Serenity's history is linear, so these simply go at the end.
+        new_entries = log_commits_and_dates("origin/master", f"^{entries[-1][0]}")
+        print(f"Found {len(new_entries)} new commits.")
+        entries.extend(new_entries)
+    else:
+        entries = log_commits_and_dates("origin/master")
+    assert entries
+    with open(FILENAME_COMMIT_LIST, "wb") as commit_list_file:
+        commit_list_file.write(orjson.dumps(entries))
+    print(f"Repo has {len(entries)} commits.")
+    return entries
+
+
 def load_cache() -> Cache:
     if not os.path.exists(FILENAME_CACHE):
-        with open(FILENAME_CACHE_COLD, "r", encoding="utf-8") as cache_file:
-            cache = json.load(cache_file)
+        snapshot = FILENAME_CACHE_LEGACY if os.path.exists(FILENAME_CACHE_LEGACY) else FILENAME_CACHE_COLD
+        with open(snapshot, "rb") as cache_file:
+            cache = orjson.loads(cache_file.read())
+        version = cache.pop(MAGIC_VERSION_KEY)
+        assert version == CACHE_VERSION, version
         # Make sure it's writable:
         save_cache(cache)
-    else:
-        with open(FILENAME_CACHE, "r", encoding="utf-8") as cache_file:
-            cache = json.load(cache_file)
+        return cache
+    cache = {}
+    truncated = False
+    with open(FILENAME_CACHE, "rb") as cache_file:
+        header = orjson.loads(cache_file.readline())
+        assert header == {"version": CACHE_VERSION}, header
+        for line in cache_file:
+            if not line.endswith(b"\n"):
+                # Probably got killed while appending. Drop the partial entry, it will be recomputed.
+                truncated = True
+                break
+            entry = orjson.loads(line)
+            cache[entry["c"]] = entry["f"], entry["s"], entry["fl"]
+    if truncated:
+        print("Repairing truncated cache")
+        save_cache(cache)
     return cache
 
 
-def save_cache(cache: Cache) -> None:
-    with open(FILENAME_CACHE, "w", encoding="utf-8") as cache_file:
-        json.dump(cache, cache_file, sort_keys=True, separators=(",", ":"), indent=0)
+def format_cache_entry(commit: str, counts: tuple[int, int, int]) -> bytes:
+    return orjson.dumps({"c": commit, "f": counts[0], "s": counts[1], "fl": counts[2]}) + b"\n"
 
 
-def count_fixmes_here() -> int:
-    # We don't use "-n" here, since we don't use that information, and less output should make it marginally faster.
-    # That is also why we use "-h".
-    result = subprocess.run(
-        ["git", "-C", SERENITY_DIR, "grep", "-IiEh", "FIXME|TODO"],
-        check=False,
-        capture_output=True,
-        text=True,
+def save_cache(cache: Cache) -> None:
+    with open(FILENAME_CACHE, "wb") as cache_file:
+        # The first line only holds the version, all others are entries.
+        cache_file.write(orjson.dumps({"version": CACHE_VERSION}) + b"\n")
+        cache_file.writelines(format_cache_entry(commit, cache[commit]) for commit in sorted(cache))
+
+
+@functools.cache
+def cat_file() -> subprocess.Popen[bytes]:
+    # One long-lived "git cat-file --batch" per worker process, instead of forking git for every file or commit.
+    return subprocess.Popen(
+        ["git", "-C", SERENITY_DIR, "cat-file", "--batch"],
+        stdin=subprocess.PIPE,
+        stdout=subprocess.PIPE,
+        env=GIT_ENV,
     )
-    assert result.returncode in [0, 1]
-    lines: list[str] = result.stdout.split("\n")
-    assert lines[-1] == "", result.stdout[-10:]
-    return len(lines)
 
 
-def count_deprecated_strings_here() -> int:
-    # We don't use "-n" here, since we don't use that information, and less output should make it marginally faster.
-    # That is also why we use "-h".
-    result = subprocess.run(
-        ["git", "-C", SERENITY_DIR, "grep", "-IEh", "DeprecatedFlyString"],
-        check=False,
-        capture_output=True,
-        text=True,
-    )
-    assert result.returncode in [0, 1]
-    lines: list[str] = result.stdout.split("\n")
-    assert lines[-1] == "", result.stdout[-10:]
-    return len(lines)
+def read_blob(blob: bytes) -> bytes:
+    process = cat_file()
+    assert process.stdin is not None and process.stdout is not None
+    process.stdin.write(blob + b"\n")
+    process.stdin.flush()
+    header = process.stdout.readline().split()
+    assert len(header) == 3 and header[0] == blob and header[1] == b"blob", header
+    data = process.stdout.read(int(header[2]))
+    assert process.stdout.read(1) == b"\n"
+    return data
 
 
-def count_deprecated_files_here() -> int:
-    # We don't use "-n" here, since we don't use that information, and less output should make it marginally faster.
-    # That is also why we use "-h".
+def list_files(commit: str) -> list[tuple[bytes, bytes]]:
     result = subprocess.run(
-        ["git", "-C", SERENITY_DIR, "grep", "-IFh", "DeprecatedFile"],
-        check=False,
+        ["git", "-C", SERENITY_DIR, "ls-tree", "-r", "-z", commit],
+        check=True,
         capture_output=True,
-        text=True,
+        env=GIT_ENV,
     )
-    assert result.returncode in [0, 1]
-    lines: list[str] = result.stdout.split("\n")
-    assert lines[-1] == "", result.stdout[-10:]
-    return len(lines)
+    files: list[tuple[bytes, bytes]] = []
+    for entry in result.stdout.split(b"\0")[:-1]:
+        meta, path = entry.split(b"\t", 1)
+        mode, _, blob = meta.split(b" ")
+        # Like "git grep", only look at regular files, not at symlinks or submodules.
+        if mode in (b"100644", b"100755"):
+            files.append((path, blob))
+    return files
+
+
+def check_diff_attributes(commit: str, paths: list[bytes]) -> dict[bytes, bool | None]:
+    # "git check-attr" can only read .gitattributes from the working tree or the index, so give it a throwaway
+    # index that contains the commit.
+    with tempfile.TemporaryDirectory() as index_dir:
+        env = {**GIT_ENV, "GIT_INDEX_FILE": os.path.join(index_dir, "index")}
+        subprocess.run(["git", "-C", SERENITY_DIR, "read-tree", commit], check=True, env=env)
+        result = subprocess.run(
+            ["git", "-C", SERENITY_DIR, "check-attr", "--cached", "--stdin", "-z", "diff"],
+            input=b"".join(path + b"\0" for path in paths),
+            check=True,
+            capture_output=True,
+            env=env,
+        )
+    fields = result.stdout.split(b"\0")[:-1]
+    assert len(fields) == 3 * len(paths), result.stdout[-100:]
+    binary: dict[bytes, bool | None] = {}
+    for i in range(0, len(fields), 3):
+        path, _, info = fields[i:i + 3]
+        # "-diff" (which is what "binary" means) forces binary, "diff" forces text, anything else is decided by looking
+        # at the content. That's what "git grep -I" does.
+        binary[path] = {b"unset": True, b"set": False}.get(info)
+    return binary
+
+
+def determine_binary_paths(commit: str, files: list[tuple[bytes, bytes]]) -> dict[bytes, bool | None]:
+    gitattributes = tuple((path, blob) for path, blob in files if path.rsplit(b"/", 1)[-1] == b".gitattributes")
+    # Most versions of .gitattributes don't touch the diff attribute at all, so there's nothing to ask git.
+    if not any(b"diff" in data or b"binary" in data for data in (read_blob(blob) for _, blob in gitattributes)):
+        return {}
+    if gitattributes not in PATH_BINARY:
+        # The attributes changed, so nothing we know about the paths is valid anymore.
+        PATH_BINARY.clear()
+        PATH_BINARY[gitattributes] = {}
+    known = PATH_BINARY[gitattributes]
+    new_paths = [path for path, _ in files if path not in known]
+    if new_paths:
+        known.update(check_diff_attributes(commit, new_paths))
+    return known
+
+
+def count_blob(data: bytes, binary: bool | None) -> tuple[int, int, int]:
+    # Same heuristic as "git grep -I": a NUL byte near the start means it's a binary file.
+    if binary or (binary is None and b"\0" in data[:8000]):
+        return 0, 0, 0
+    # The line regex is slow compared to a plain substring search, and most files don't contain any of the
+    # patterns, so check for the literals first.
+    lowered = data.lower()
+    if b"fixme" not in lowered and b"todo" not in lowered and b"deprecated" not in lowered:
+        return 0, 0, 0
+    # Find all interesting lines in a single pass, then sort them into buckets. A line can count for several
+    # patterns, and we count lines, not matches, just like "git grep" would.
+    # FIXMEs and TODOs are case-insensitive, but the deprecated types are not.
+    fixmes, deprecated_strings, deprecated_files = 0, 0, 0
+    for match in MATCHING_LINE_RE.finditer(lowered):
+        lowered_line = match[0]
+        line = data[match.start():match.end()]
+        # The grep-based counting read the output in text mode, which turned every lone "\r" into a line break.
+        # A "\r" at the end of the line became part of the "\r\n" that ends it, though.
+        weight = 1 + line.count(b"\r") - line.endswith(b"\r")
+        if b"fixme" in lowered_line or b"todo" in lowered_line:
+            fixmes += weight
+        if b"DeprecatedFlyString" in line:
+            deprecated_strings += weight
+        if b"DeprecatedFile" in line:
+            deprecated_files += weight
+    return fixmes, deprecated_strings, deprecated_files
+
+
+def count_commit(commit: str) -> tuple[tuple[int, int, int], float]:
+    time_start = time.time()
+    # The grep-based counting used to count one line too many (the empty string after the last newline).
+    # Keep doing that, so that new counts stay comparable with the ones already in the cache.
+    fixmes, deprecated_strings, deprecated_files = 1, 1, 1
+    files = list_files(commit)
+    binary_paths = determine_binary_paths(commit, files)
+    blob_counts: dict[tuple[bytes, bool | None], tuple[int, int, int]] = {}
+    for path, blob in files:
+        binary = binary_paths.get(path)
+        if binary:
+            continue
+        # Consecutive commits share almost all of their files, so most blobs only need to be read once per worker.
+        counts = BLOB_COUNTS.get((blob, binary))
+        if counts is None:
+            counts = count_blob(read_blob(blob), binary)
+        blob_counts[blob, binary] = counts
+        fixmes += counts[0]
+        deprecated_strings += counts[1]
+        deprecated_files += counts[2]
+    # Only keep the blobs of this commit, older ones are unlikely to come back and would add up over the whole history.
+    BLOB_COUNTS.clear()
+    BLOB_COUNTS.update(blob_counts)
+    return (fixmes, deprecated_strings, deprecated_files), time.time() - time_start
+
+
+def extend_cache(commits: list[str], cache: Cache) -> None:
+    uncached = [commit for commit in commits if commit not in cache]
+    if not uncached:
+        return
+    print(f"Counting {len(uncached)} new commits with {MAX_WORKERS} workers.")
+    with (
+        concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor,
+        open(FILENAME_CACHE, "ab") as cache_file,
+    ):
+        futures = {executor.submit(count_commit, commit): commit for commit in uncached}
+        for num_done, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            commit = futures[future]
+            try:
+                cache[commit], time_counting = future.result()
+            except BaseException:
+                # Leaving the with block would wait for all queued commits, only to throw their counts away.
+                executor.shutdown(cancel_futures=True)
+                raise
+            time_start_saving = time.time()
+            cache_file.write(format_cache_entry(commit, cache[commit]))
+            if num_done % SAVE_CACHE_INV_FREQ == 0:
+                print("    (actually syncing cache)")
+                cache_file.flush()
+                os.fsync(cache_file.fileno())
+            time_done_saving = time.time()
+            print(
+                f"Extended cache by {commit} (now containing {len(cache)} keys) (counting took {time_counting}s, saving took {time_done_saving - time_start_saving}s)"
+            )
 
 
 def lookup_commit(commit: str, date: int, cache: Cache) -> dict[str, int | str]:
-    if commit in cache:
-        fixmes, deprecated_strings, deprecated_files = cache[commit]
-    else:
-        time_start = time.time()
-        subprocess.run(["git", "-C", SERENITY_DIR, "checkout", "-q", commit], check=True)
-        fixmes = count_fixmes_here()
-        deprecated_strings = count_deprecated_strings_here()
-        deprecated_files = count_deprecated_files_here()
-        time_done_counting = time.time()
-        cache[commit] = fixmes, deprecated_strings, deprecated_files
-        if len(cache) % SAVE_CACHE_INV_FREQ == 0:
-            print("    (actually saving cache)")
-            save_cache(cache)
-        time_done_saving = time.time()
-        print(
-            f"Extended cache by {commit} (now containing {len(cache)} keys) (counting took {time_done_counting - time_start}s, saving took {time_done_saving - time_done_counting}s)"
-        )
+    fixmes, deprecated_strings, deprecated_files = cache[commit]
     return {
         "commit": commit,
         "unix_timestamp": date,
-        "human_readable_time": datetime.datetime.fromtimestamp(date).strftime("%Y-%m-%d %H:%M:%S"),
         "fixmes": fixmes,
         "deprecated_strings": deprecated_strings,
         "deprecated_files": deprecated_files,
     }
 
 
-def write_graphs(most_recent_commit: int) -> None:
-    time_now = int(time.time())
-    print(f"Plotting with {time_now=}")
-    time_last_week = time_now - 3600 * 24 * 7
-    time_last_month = time_now - 3600 * 24 * 31  # All months are 31 days. Right.
-    time_last_year = time_now - 3600 * 24 * 366  # All years are 366 days. Right.
-    timed_plot_commands = ""
-
+def determine_gnuplot_epoch() -> int:
+    # The answer only changes when gnuplot gets upgraded, so remember it instead of asking gnuplot every time.
+    if os.path.exists(FILENAME_GNUPLOT_EPOCH):
+        with open(FILENAME_GNUPLOT_EPOCH, "r", encoding="utf-8") as epoch_file:
+            return int(epoch_file.read())
     # *Some* versions of gnuplot use year 2000 as epoch, and in those versions *only*
     # the xrange is interpreted relative to this. Aaargh!
     output = subprocess.check_output(['gnuplot', '--version']).split()
@@ -174,6 +368,21 @@ def write_graphs(most_recent_commit: int) -> None:
         gnuplot_stupidity = 946684800
     else:
         gnuplot_stupidity = 0
+    with open(FILENAME_GNUPLOT_EPOCH, "w", encoding="utf-8") as epoch_file:
+        epoch_file.write(f"{gnuplot_stupidity}\n")
+    return gnuplot_stupidity
+
+
+def start_writing_graphs(most_recent_commit: int) -> subprocess.Popen[bytes]:
+    # Only starts gnuplot, the caller has to wait for it.
+    time_now = int(time.time())
+    print(f"Plotting with {time_now=}")
+    time_last_week = time_now - 3600 * 24 * 7
+    time_last_month = time_now - 3600 * 24 * 31  # All months are 31 days. Right.
+    time_last_year = time_now - 3600 * 24 * 366  # All years are 366 days. Right.
+    timed_plot_commands = ""
+
+    gnuplot_stupidity = determine_gnuplot_epoch()
 
     if most_recent_commit > time_last_week:
         timed_plot_commands += f"""
@@ -199,7 +408,7 @@ def write_graphs(most_recent_commit: int) -> None:
     else:
         print(f"ERROR: No commits in the last YEAR?! (now={time_now}, a year ago={time_last_year}, latest_commit={most_recent_commit})")
         raise AssertionError()
-    subprocess.run(
+    return subprocess.Popen(
         [
             "gnuplot",
             "-e",
@@ -220,62 +429,102 @@ def write_graphs(most_recent_commit: int) -> None:
                 {timed_plot_commands}
             """,
         ],
-        check=True,
     )
 
 
+def count_todos_and_locs(full_name: str) -> tuple[int, int]:
+    with open(full_name, "rb") as file_p:
+        data = file_p.read()
+    # The flame graph counts occurrences instead of lines, so plain substring counting is enough.
+    # The two words can't overlap, so counting them separately is the same as counting either one.
+    lowered = data.lower()
+    todos = lowered.count(b"fixme") + lowered.count(b"todo")
+    # Like reading in text mode, a lone "\r" ends a line as well.
+    data = data.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+    # Every newline starts another line, even if it's the empty "line" at the very end of the file.
+    # That one is matched by "\Z" in NON_CODE_LINE_RE, so it cancels out.
+    locs = data.count(b"\n") + 1 - len(NON_CODE_LINE_RE.findall(data))
+    return todos, locs
+
+
+def walk_files(path: str) -> Iterator[os.DirEntry[str]]:
+    # Like os.walk(topdown=False), files come after everything in the subdirectories, which decides the order of
+    # the nodes in the flame graph. Unlike os.walk, this doesn't need to stat every entry a second time.
+    # The stack holds directories that still need to be listed, and lists of files that are ready to be yielded.
+    stack: list[str | list[os.DirEntry[str]]] = [path]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, list):
+            yield from item
+            continue
+        files = []
+        directories = []
+        with os.scandir(item) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in IGNORED_DIRECTORIES:
+                        directories.append(entry.path)
+                elif entry.is_file():
+                    files.append(entry)
+        stack.append(files)
+        stack.extend(reversed(directories))
+
+
 def generate_flame_graph() -> None:   # noqa: MC0001
     flamegraph = Node(name=".", children=[])
 
-    def get_node(path: str) -> Node | None:
+    def get_node(path: str) -> Node:
         node = flamegraph
         for file_name in os.path.normpath(path).split(os.path.sep):
-            if file_name in [".git", ".devcontainer"]:
-                return None
-            for child in node.children:
-                if child.name == file_name:
-                    node = child
-                    break
-            else:
-                new_node = Node(name=file_name, children=[])
-                node.children.append(new_node)
-                node = new_node
+            child = node.children_by_name.get(file_name)
+            if child is None:
+                child = Node(name=file_name, children=[])
+                node.children.append(child)
+                node.children_by_name[file_name] = child
+            node = child
         return node
 
-    previous_wd = os.getcwd()
-    os.chdir(SERENITY_DIR)
-
     ratios_list = []
-
-    for root, dirs, files in os.walk(".", topdown=False):
-        for name in files:
-            full_name = os.path.join(root, name)
-            if not any(name.endswith(ext) for ext in [".h", ".c", ".cpp", ".html", ".js", ".sh", "*.txt", "*.cmake"]):
-                continue
-            if full_name in ["./Tests/LibWeb/Layout/input/html-encoding-detection-crash.html",
-                             "./Tests/LibWeb/Layout/input/utf-16-be-xhtml-file-should-decode-correctly.html"]:
-                continue
-            node = get_node(full_name)
-            if not node:
-                continue
-            todos = 0
-            locs = 0
-            with open(full_name, "rt", encoding="utf-8") as file_p:
-                try:
-                    for line in file_p:
-                        line = line.strip().upper()
-                        todos += line.count("FIXME") + line.count("TODO")
-                        if line and not line.startswith("//"):
-                            locs += 1
-                except UnicodeDecodeError as err:
-                    print(f"Error decodingfile {full_name}: {err}")
-                    continue
+    full_names: list[str] = []
+    max_mtime = 0
+
+    for entry in walk_files(SERENITY_DIR):
+        if not entry.name.endswith(SOURCE_EXTENSIONS):
+            continue
+        full_name = entry.path[len(SERENITY_DIR):]
+        if full_name in ["Tests/LibWeb/Layout/input/html-encoding-detection-crash.html",
+                         "Tests/LibWeb/Layout/input/utf-16-be-xhtml-file-should-decode-correctly.html"]:
+            continue
+        full_names.append(full_name)
+        max_mtime = max(max_mtime, entry.stat().st_mtime_ns)
+
+    # If HEAD and all files are the same as last time, then so is the output. The number of files catches deletions.
+    # Only a persistent checkout (build_and_publish.sh) keeps the stamp around, a fresh clone always regenerates.
+    head = subprocess.run(
+        ["git", "-C", SERENITY_DIR, "rev-parse", "HEAD"],
+        check=True,
+        capture_output=True,
+        text=True,
+        env=GIT_ENV,
+    ).stdout.strip()
+    stamp = f"{FLAMEGRAPH_FORMAT_VERSION} {head} {len(full_names)} {max_mtime}\n"
+    if all(os.path.exists(filename) for filename in FLAMEGRAPH_OUTPUTS) and os.path.exists(FILENAME_FLAMEGRAPH_STAMP):
+        with open(FILENAME_FLAMEGRAPH_STAMP, "r", encoding="utf-8") as stamp_file:
+            if stamp_file.read() == stamp:
+                print("Flame graph is up to date, skipping.")
+                return
+
+    file_nodes = [(full_name, get_node(full_name)) for full_name in full_names]
+
+    # Reading and counting the files is the expensive part, so do that in parallel.
+    # The tree itself is only touched from this process.
+    with concurrent.futures.ProcessPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        all_counts = executor.map(count_todos_and_locs, [SERENITY_DIR + full_name for full_name, _ in file_nodes], chunksize=64)
+        for (full_name, node), (todos, locs) in zip(file_nodes, all_counts):
             node.todos = todos
             node.locs = locs
 
             if todos and locs:
-                if full_name.startswith("./"):
-                    full_name = full_name[2:]
                 ratios_list.append([
                     todos,
                     locs,
@@ -283,39 +532,57 @@ def generate_flame_graph() -> None:   # noqa: MC0001
                     full_name
                 ])
 
-        for name in dirs:
-            node = get_node(os.path.join(root, name))
-            if not node:
-                continue
-            node.todos = sum(child.todos for child in node.children)
-            node.locs = sum(child.locs for child in node.children)
-    os.chdir(previous_wd)
-
-    def set_value(calculate: Callable[[Node], int], node: Node) -> OutputNode:
-        children = []
-        for child in node.children:
-            new_child = set_value(calculate, child)
-            if new_child["value"] or new_child.get("children", []):
-                children.append(new_child)
+    def output_node(name: str, value: int, children: list[OutputNode]) -> OutputNode:
         new_node: OutputNode = {
-            "name": node.name,
-            "value": calculate(node)
+            "name": name,
+            "value": value
         }
         if children:
             new_node["children"] = children
         return new_node
 
-    todo_graph = set_value(lambda node: node.todos, flamegraph)
-    with open("todo.json", "wt", encoding="utf-8") as file:
-        json.dump(todo_graph, file, separators=(",", ":"))
-
-    loc_graph = set_value(lambda node: node.locs, flamegraph)
-    with open("loc.json", "wt", encoding="utf-8") as file:
-        json.dump(loc_graph, file, separators=(",", ":"))
-
-    with open("ratio.csv", "wt", encoding="utf-8") as file:
-        file.write("TODO,LOC,TODO/LOC,FILE\n")
-        file.writelines(f"{e[0]},{e[1]},{e[2]:.2%},<a href=\"https://github.com/SerenityOS/serenity/blob/master/{e[3]}\">{e[3]}</a>\n" for e in ratios_list)
+    def set_values(root: Node) -> tuple[OutputNode, OutputNode]:
+        # Builds the TODO and the LOC graph in the same walk, since both have the shape of the tree.
+        # Post-order traversal with an explicit stack: a node is only visited for the second time after all of its
+        # children have been converted, so that's also where the directories get their sums.
+        converted: dict[int, tuple[OutputNode, OutputNode]] = {}
+        stack: list[tuple[Node, bool]] = [(root, False)]
+        while stack:
+            node, children_done = stack.pop()
+            if not children_done:
+                stack.append((node, True))
+                stack.extend((child, False) for child in node.children)
+                continue
+            # The root itself is intentionally left at zero.
+            if node.children and node is not root:
+                node.todos = sum(child.todos for child in node.children)
+                node.locs = sum(child.locs for child in node.children)
+            todo_children = []
+            loc_children = []
+            for child in node.children:
+                todo_child, loc_child = converted.pop(id(child))
+                if todo_child["value"] or todo_child.get("children", []):
+                    todo_children.append(todo_child)
+                if loc_child["value"] or loc_child.get("children", []):
+                    loc_children.append(loc_child)
+            converted[id(node)] = (
+                output_node(node.name, node.todos, todo_children),
+                output_node(node.name, node.locs, loc_children),
+            )
+        return converted[id(root)]
+
+    todo_graph, loc_graph = set_values(flamegraph)
+    with open("todo.json", "wb") as todo_file:
+        todo_file.write(orjson.dumps(todo_graph))
+    with open("loc.json", "wb") as loc_file:
+        loc_file.write(orjson.dumps(loc_graph))
+
+    with open("ratio.csv", "wt", encoding="utf-8") as ratio_file:
+        ratio_file.write("TODO,LOC,TODO/LOC,FILE\n")
+        ratio_file.writelines(f"{e[0]},{e[1]},{e[2]:.2%},<a href=\"https://github.com/SerenityOS/serenity/blob/master/{e[3]}\">{e[3]}</a>\n" for e in ratios_list)
+
+    with open(FILENAME_FLAMEGRAPH_STAMP, "w", encoding="utf-8") as stamp_file:
+        stamp_file.write(stamp)
 
 
 def run() -> None:
@@ -332,16 +599,19 @@ def run() -> None:
         f"(The time is {current_time}, the last commit is {current_time - commits_and_dates[-1][1]}s ago)"
     )
     cache = load_cache()
-    tagged_commits = [
-        lookup_commit(commit, date, cache) for commit, date in commits_and_dates
-    ]
-    save_cache(cache)
+    extend_cache([commit for commit, _ in commits_and_dates], cache)
     with open(FILENAME_CSV, "w", encoding="utf-8") as csv_file:
-        for entry in tagged_commits:
+        for commit, date in commits_and_dates:
+            entry = lookup_commit(commit, date, cache)
             csv_file.write(f"{entry['unix_timestamp']},{entry['fixmes']},{entry['deprecated_strings']},{entry['deprecated_files']}\n")
-    write_graphs(commits_and_dates[-1][1])
 
+    # gnuplot only needs the CSV, and the flame graph only needs the Serenity checkout, so let them overlap.
+    gnuplot = start_writing_graphs(commits_and_dates[-1][1])
+    # The counting above never touches the working tree, but the flame graph is computed from it.
+    subprocess.run(["git", "-C", SERENITY_DIR, "checkout", "-q", commits_and_dates[-1][0]], check=True)
     generate_flame_graph()
+    if gnuplot.wait() != 0:
+        raise subprocess.CalledProcessError(gnuplot.returncode, gnuplot.args)
 
 
 if __name__ == "__main__":
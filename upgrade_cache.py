@@ -14,6 +14,8 @@ import time
 # V4: Three numbers for /FIXME|TODO/i and for /Deprecated(Fly)?String/ and for /DeprecatedFile/
 #     (Note that Deprecated(Fly)?String became case-sensitive, but this does not
 #      affect the number of matches as of d7b067e8f7a8c6e52c1b513b8d2a2ded22966376)
+#     update_counts.py now keeps V4 as one JSON object per line in cache_v4.jsonl, where the first line is
+#     {"version":4} instead of the MAGIC_VERSION_KEY entry.
 
 SERENITY_DIR = "serenity/"
 LAST_COMMIT_BEFORE_DEPRECATEDFILE = "14951b92ca6160664ccb68c5e1b2d40133763e5f"